@@ -1,24 +1,60 @@
 import os
-import json
+import asyncio
+import hashlib
 import datetime
+import logging
+import logging.handlers
+import queue
+import time
 import traceback
 
 import aiosqlite
 import httpx
-from fastapi import FastAPI, Request
-from openai import OpenAI
+import orjson
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI
 
-print("🔥🔥🔥 RUNNING NEW GPT VERSION v2026-02-02 🔥🔥🔥")
+# =========================
+# Logging
+# =========================
+# Handlers run on a listener thread so the event loop never blocks on a
+# stdout write (line-buffered stdout can stall under log aggregation).
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+# Attach the QueueHandler to the root logger directly: basicConfig would
+# give it a default formatter, making prepare() pre-render level/name into
+# the message and the listener-side formatter render them again.
+_root_logger = logging.getLogger()
+_root_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_root_logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger("tv-webhook")
+
+logger.info("🔥🔥🔥 RUNNING NEW GPT VERSION v2026-02-02 🔥🔥🔥")
 
 # =========================
 # App / Config
 # =========================
 APP_VERSION = "gpt-chatcompletions-v2"
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
-client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+# Tight timeout + bounded SDK retries: a slow OpenAI incident must not
+# pin background tasks for the default tens of seconds
+client = (
+    AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        timeout=httpx.Timeout(5.0, connect=2.0),
+        max_retries=2,
+    )
+    if OPENAI_API_KEY
+    else None
+)
 
 # Twilio WhatsApp (optional)
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID", "").strip()
@@ -28,49 +64,59 @@ WHATSAPP_TO = os.getenv("WHATSAPP_TO", "").strip()  # e.g. "whatsapp:+90xxxxxxxx
 
 DB_PATH = os.getenv("DB_PATH", "tradelog.db").strip() or "tradelog.db"
 
-print(f"APP VERSION: {APP_VERSION}")
-print("OPENAI_API_KEY loaded:", bool(OPENAI_API_KEY))
-print("WhatsApp configured:", bool(TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_WHATSAPP_FROM and WHATSAPP_TO))
+# TradingView alerts are tiny; anything bigger than this is abuse
+MAX_BODY_BYTES = 64 * 1024
+
+logger.info("APP VERSION: %s", APP_VERSION)
+logger.info("OPENAI_API_KEY loaded: %s", bool(OPENAI_API_KEY))
+logger.info(
+    "WhatsApp configured: %s",
+    bool(TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_WHATSAPP_FROM and WHATSAPP_TO),
+)
 
 
 # =========================
 # Risk instructions (GPT)
 # =========================
-RISK_INSTRUCTIONS = """
-你是BTC永续合约 15m 信号的风控助手（OKX:BTCUSDT.P）。
-你只输出严格 JSON，不要输出多余文字，不要 markdown，不要代码块。
-
-目标：过滤低质量信号，尽量避免追涨杀跌。
-
-规则（重点）：
-- 15m 噪音大：条件不足 -> action=wait
-- 若 signal=LONG 但 payload 提供 htf4h/htf1d 且为 BEAR -> wait
-- 若 signal=SHORT 但 payload 提供 htf4h/htf1d 且为 BULL -> wait
-- 默认止损 sl_pct 0.7~1.0；止盈 tp_pct 2.0~3.2
-- 风险高时：降低置信度、提高 wait 概率
-- 输出中文风控话术 1-2 句，不能承诺收益
-
-输出格式固定：
-{
-  "action": "enter" | "wait",
-  "direction": "long" | "short",
-  "confidence": 0-100,
-  "risk_level": "low" | "mid" | "high",
-  "sl_pct": number,
-  "tp_pct": number,
-  "message_cn": "中文风控话术(1-2句)",
-  "checklist": ["...","...","..."]
-}
-""".strip()
+# Kept in a separate file so the prompt exists once, not as a duplicated
+# module-level string constant in every main.py variant.
+with open(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "risk_instructions.txt"),
+    encoding="utf-8",
+) as _f:
+    RISK_INSTRUCTIONS = _f.read().strip()
 
 
 # =========================
 # Helpers
 # =========================
-def safe_json_loads(text: str):
+_ts_cached_sec = 0
+_ts_cached_str = ""
+
+
+def utc_iso_now() -> str:
+    # utcnow() is deprecated and datetime formatting is pure-Python work;
+    # second granularity is plenty for a trade log, so cache the string.
+    global _ts_cached_sec, _ts_cached_str
+    sec = int(time.time())
+    if sec != _ts_cached_sec:
+        _ts_cached_sec = sec
+        _ts_cached_str = datetime.datetime.fromtimestamp(sec, datetime.timezone.utc).isoformat()
+    return _ts_cached_str
+
+
+def safe_json_loads(data):
+    # Peek the first byte: plain-text alerts like "TV_FORCE_TEST" can't be
+    # JSON, and skipping the parse avoids paying exception construction for
+    # a case the code explicitly supports. orjson accepts bytes directly.
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    s = data.lstrip()
+    if not s or s[0] not in b'{["0123456789tfn-':
+        return None
     try:
-        return json.loads(text)
-    except Exception:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
         return None
 
 
@@ -111,73 +157,255 @@ async def send_whatsapp(text: str):
         return
 
     url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
-    async with httpx.AsyncClient(timeout=20) as hc:
-        resp = await hc.post(
-            url,
-            data={"From": TWILIO_WHATSAPP_FROM, "To": WHATSAPP_TO, "Body": text},
-            auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
-        )
-        resp.raise_for_status()
-
-
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS signals(
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              ts_utc TEXT,
-              path TEXT,
-              raw_text TEXT,
-              json_payload TEXT,
-              gpt_json TEXT,
-              error TEXT
-            )
-            """
+    resp = await app.state.http.post(
+        url,
+        data={"From": TWILIO_WHATSAPP_FROM, "To": WHATSAPP_TO, "Body": text},
+        auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+    )
+    resp.raise_for_status()
+
+
+async def init_db(db: aiosqlite.Connection):
+    # WAL + friends: readers don't block the writer, fsyncs are amortized.
+    # journal_mode/mmap_size persist in the db file, the rest are re-applied
+    # per connection. Skip for :memory: (WAL needs a real file).
+    if DB_PATH != ":memory:":
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA busy_timeout=5000")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA cache_size=-65536")
+        await db.execute("PRAGMA mmap_size=10737418240")
+    # raw holds the original webhook bytes verbatim; the parsed form can
+    # always be regenerated on read, so there is no json_payload copy.
+    # Schema change from the old raw_text/json_payload layout -- remove or
+    # migrate an existing tradelog.db when upgrading.
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS signals(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          ts_utc TEXT,
+          path TEXT,
+          raw BLOB,
+          gpt_json TEXT,
+          error TEXT
         )
-        await db.commit()
+        """
+    )
+    # Time-range queries over the trade log should not scan the table
+    await db.execute("CREATE INDEX IF NOT EXISTS ix_signals_ts ON signals(ts_utc)")
+    await db.commit()
+
+
+# One module-level SQL literal: sqlite3 keys its prepared-statement cache
+# on the exact string, so reusing this constant means the INSERT is parsed
+# and planned once per connection, not per webhook.
+INSERT_SIGNAL_SQL = "INSERT INTO signals(ts_utc, path, raw, gpt_json, error) VALUES(?,?,?,?,?)"
+
+WRITE_BATCH_MAX = 64  # rows per transaction
+WRITE_BATCH_WAIT = 0.1  # seconds to wait for more rows before committing
+
+
+async def db_writer():
+    # Drain the queue into batched transactions: one commit (and one WAL
+    # fsync) per batch instead of per row. A None sentinel stops the loop
+    # after the current batch is committed, so shutdown loses nothing.
+    db = app.state.db
+    q = app.state.write_q
+    while True:
+        row = await q.get()
+        if row is None:
+            return
+        rows = [row]
+        stopping = False
+        try:
+            while len(rows) < WRITE_BATCH_MAX:
+                row = await asyncio.wait_for(q.get(), timeout=WRITE_BATCH_WAIT)
+                if row is None:
+                    stopping = True
+                    break
+                rows.append(row)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            async with app.state.db_lock:
+                await db.executemany(INSERT_SIGNAL_SQL, rows)
+                await db.commit()
+        except Exception as e:
+            logger.error("DB write failed: %r", e)
+        if stopping:
+            return
+
+
+CHECKPOINT_INTERVAL = 60  # seconds
+
+
+async def periodic_checkpoint():
+    # Under steady INSERT load the WAL file grows without bound; truncate
+    # it back regularly so disk usage and read cost stay flat.
+    db = app.state.db
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        try:
+            async with app.state.db_lock:
+                await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logger.error("WAL checkpoint failed: %r", e)
 
 
 # =========================
 # GPT call (Chat Completions)
 # =========================
-async def call_gpt_risk(payload: dict) -> dict:
-    # If no key / client -> fallback
-    if not client:
-        return default_gpt_fallback(payload, "未配置OPENAI_API_KEY")
+def pre_filter(payload: dict):
+    # The explicit rules in RISK_INSTRUCTIONS are deterministic -- no need to
+    # pay GPT latency/cost for them. Returns a ready g dict, or None for the
+    # ambiguous cases that do need GPT.
+    sig = (payload.get("signal") or "").upper()
 
+    if sig not in ("LONG", "SHORT"):
+        return {
+            "action": "wait",
+            "direction": "long",
+            "confidence": 0,
+            "risk_level": "high",
+            "sl_pct": 0.9,
+            "tp_pct": 2.2,
+            "message_cn": "信号缺失或无法识别，先观望，等待明确的15m入场信号。",
+            "checklist": ["确认信号来源", "确认4H/1D方向", "确认关键位"],
+        }
+
+    htf = {(payload.get("htf4h") or "").upper(), (payload.get("htf1d") or "").upper()}
+    if (sig == "LONG" and "BEAR" in htf) or (sig == "SHORT" and "BULL" in htf):
+        return {
+            "action": "wait",
+            "direction": "long" if sig == "LONG" else "short",
+            "confidence": 10,
+            "risk_level": "high",
+            "sl_pct": 0.9,
+            "tp_pct": 2.2,
+            "message_cn": "15m信号与高周期方向冲突，追单风险大，建议观望。",
+            "checklist": ["确认4H/1D方向", "确认前高前低/关键位", "等待高周期同向"],
+        }
+
+    return None
+
+
+# TradingView likes to re-fire the same alert within seconds; identical
+# payloads get the cached GPT answer instead of a new API call.
+gpt_cache = TTLCache(maxsize=1024, ttl=60)
+
+# Byte-identical re-fires (partial connection failures make TV resend)
+# are dropped outright before any processing
+dedup_cache = TTLCache(maxsize=4096, ttl=10)
+
+
+def gpt_cache_key(payload: dict) -> bytes:
+    price = payload.get("price", payload.get("close"))
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": RISK_INSTRUCTIONS},
-                {"role": "user", "content": json.dumps(payload, ensure_ascii=False)},
-            ],
-            temperature=0.2,
-        )
+        price = round(float(price), 1)
+    except (TypeError, ValueError):
+        price = None
+    norm = (
+        payload.get("ticker", payload.get("symbol")),
+        payload.get("interval", payload.get("timeframe")),
+        payload.get("signal"),
+        price,
+        payload.get("htf4h"),
+        payload.get("htf1d"),
+    )
+    return hashlib.blake2b(repr(norm).encode(), digest_size=16).digest()
+
+
+def sanitize_g(g: dict, payload: dict) -> dict:
+    # Basic sanity defaults
+    g.setdefault("action", "wait")
+    g.setdefault("direction", "long" if (payload.get("signal") or "").upper() == "LONG" else "short")
+    g.setdefault("confidence", 0)
+    g.setdefault("risk_level", "mid")
+    g.setdefault("sl_pct", 0.9)
+    g.setdefault("tp_pct", 2.5)
+    g.setdefault("message_cn", "建议谨慎，等待更清晰的结构确认。")
+    g.setdefault("checklist", ["确认趋势方向", "确认关键位", "确认波动是否异常"])
+    return g
+
+
+GPT_BATCH_MAX = 8
+GPT_BATCH_WAIT = 0.2  # seconds to collect concurrent alerts into one call
+
+BATCH_INSTRUCTIONS_SUFFIX = (
+    "\n\n用户消息是一个 JSON 数组，包含多条独立信号。"
+    "对每条信号分别按上述格式输出 JSON 对象，"
+    "并以 JSON 数组返回，顺序与输入一致，数量相同。"
+)
+
+
+async def gpt_batcher():
+    # Alerts arriving within GPT_BATCH_WAIT of each other share one GPT
+    # request: the long RISK_INSTRUCTIONS prompt is paid once per batch
+    # instead of once per alert.
+    q = app.state.gpt_q
+    while True:
+        batch = [await q.get()]
+        try:
+            while len(batch) < GPT_BATCH_MAX:
+                batch.append(await asyncio.wait_for(q.get(), timeout=GPT_BATCH_WAIT))
+        except asyncio.TimeoutError:
+            pass
+
+        payloads = [p for p, _ in batch]
+        results = None
+        reason = "GPT输出非JSON"
+        try:
+            resp = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": RISK_INSTRUCTIONS + BATCH_INSTRUCTIONS_SUFFIX},
+                    {"role": "user", "content": orjson.dumps(payloads).decode()},
+                ],
+                temperature=0.2,
+            )
+            text = (resp.choices[0].message.content or "").strip()
+            parsed = safe_json_loads(text)
+            if isinstance(parsed, list):
+                results = parsed
+            elif isinstance(parsed, dict) and len(batch) == 1:
+                results = [parsed]
+        except (APITimeoutError, APIConnectionError) as e:
+            logger.warning("GPT call timed out: %r", e)
+            reason = "GPT超时"
+        except Exception as e:
+            logger.warning("GPT call failed: %r", e)
+            reason = "GPT调用异常"
+
+        for i, (payload, fut) in enumerate(batch):
+            r = results[i] if results is not None and i < len(results) else None
+            if isinstance(r, dict):
+                g = sanitize_g(r, payload)
+                gpt_cache[gpt_cache_key(payload)] = g
+            else:
+                g = default_gpt_fallback(payload, reason)
+            if not fut.done():
+                fut.set_result(g)
 
-        text = (resp.choices[0].message.content or "").strip()
-        g = safe_json_loads(text)
 
-        if not isinstance(g, dict):
-            # JSON parse failed
-            return default_gpt_fallback(payload, "GPT输出非JSON")
+async def call_gpt_risk(payload: dict) -> dict:
+    # Rule-based cases never reach GPT
+    g = pre_filter(payload)
+    if g is not None:
+        return g
 
-        # Basic sanity defaults
-        g.setdefault("action", "wait")
-        g.setdefault("direction", "long" if (payload.get("signal") or "").upper() == "LONG" else "short")
-        g.setdefault("confidence", 0)
-        g.setdefault("risk_level", "mid")
-        g.setdefault("sl_pct", 0.9)
-        g.setdefault("tp_pct", 2.5)
-        g.setdefault("message_cn", "建议谨慎，等待更清晰的结构确认。")
-        g.setdefault("checklist", ["确认趋势方向", "确认关键位", "确认波动是否异常"])
+    # If no key / client -> fallback
+    if not client:
+        return default_gpt_fallback(payload, "未配置OPENAI_API_KEY")
 
-        return g
+    cached = gpt_cache.get(gpt_cache_key(payload))
+    if cached is not None:
+        return cached
 
-    except Exception as e:
-        print("GPT call failed:", repr(e))
-        return default_gpt_fallback(payload, "GPT调用异常")
+    # Hand off to the batcher and wait for our slice of the answer
+    fut = asyncio.get_running_loop().create_future()
+    await app.state.gpt_q.put((payload, fut))
+    return await fut
 
 
 # =========================
@@ -185,7 +413,36 @@ async def call_gpt_risk(payload: dict) -> dict:
 # =========================
 @app.on_event("startup")
 async def startup():
-    await init_db()
+    # One connection for the life of the process: no connect/close per webhook,
+    # and the PRAGMAs stick. aiosqlite runs on a single background thread, so
+    # writes are serialized through a lock.
+    app.state.db = await aiosqlite.connect(DB_PATH, cached_statements=128)
+    app.state.db_lock = asyncio.Lock()
+    await init_db(app.state.db)
+    app.state.write_q = asyncio.Queue()
+    app.state.writer_task = asyncio.create_task(db_writer())
+    app.state.checkpoint_task = None
+    if DB_PATH != ":memory:":
+        app.state.checkpoint_task = asyncio.create_task(periodic_checkpoint())
+    app.state.gpt_q = asyncio.Queue()
+    app.state.gpt_task = asyncio.create_task(gpt_batcher())
+    # Shared client: keepalive connections to api.twilio.com instead of a
+    # fresh TLS handshake per message
+    app.state.http = httpx.AsyncClient(
+        timeout=20, limits=httpx.Limits(max_keepalive_connections=10)
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.http.aclose()
+    app.state.gpt_task.cancel()
+    if app.state.checkpoint_task:
+        app.state.checkpoint_task.cancel()
+    # Sentinel: the writer commits everything queued ahead of it, then exits
+    await app.state.write_q.put(None)
+    await app.state.writer_task
+    await app.state.db.close()
 
 
 @app.get("/")
@@ -194,29 +451,53 @@ def root():
 
 
 @app.post("/")
-async def webhook_root(req: Request):
-    return await handle_webhook(req, path="/")
+async def webhook_root(req: Request, bt: BackgroundTasks):
+    return await handle_webhook(req, bt, path="/")
 
 
 @app.post("/tv-webhook")
-async def tv_webhook(req: Request):
-    return await handle_webhook(req, path="/tv-webhook")
-
+async def tv_webhook(req: Request, bt: BackgroundTasks):
+    return await handle_webhook(req, bt, path="/tv-webhook")
+
+
+async def handle_webhook(req: Request, bt: BackgroundTasks, path: str):
+    # Stream the body with a hard cap instead of buffering arbitrary sizes
+    size = 0
+    chunks = []
+    async for chunk in req.stream():
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            logger.warning("oversized body rejected path=%s size>%d", path, MAX_BODY_BYTES)
+            return Response(status_code=413)
+        chunks.append(chunk)
+    raw = b"".join(chunks)
+
+    # Dedupe gate: first sight of this exact body within the TTL wins
+    dedup_key = hashlib.blake2b(raw, digest_size=16).digest()
+    if dedup_key in dedup_cache:
+        logger.info("duplicate alert dropped path=%s", path)
+        return {"ok": True, "dedup": True}
+    dedup_cache[dedup_key] = True
+
+    logger.info("webhook received path=%s bytes=%d", path, len(raw))
+    logger.debug("RAW: %s", raw[:2000])  # limit log size
+
+    # Parse JSON straight from the bytes; decode to text only on the
+    # nontext fallback and at DB-insert time
+    payload = safe_json_loads(raw)
+    if payload is None:
+        payload = {"raw": raw.decode("utf-8", errors="ignore").strip()}
 
-async def handle_webhook(req: Request, path: str):
-    error_text = ""
-    raw = await req.body()
-    text = raw.decode("utf-8", errors="ignore").strip()
+    payload.setdefault("recv_ts_utc", utc_iso_now())
 
-    print(f"=== Webhook Received at {path} ===")
-    print("RAW:", text[:2000])  # limit log size
+    # TradingView only needs a quick 200; GPT + DB + WhatsApp run after
+    # the response goes out
+    bt.add_task(process_alert, payload, raw, path)
+    return {"ok": True}
 
-    # Parse JSON or treat as text
-    payload = safe_json_loads(text)
-    if payload is None:
-        payload = {"raw": text}
 
-    payload.setdefault("recv_ts_utc", datetime.datetime.utcnow().isoformat())
+async def process_alert(payload: dict, raw: bytes, path: str):
+    error_text = ""
 
     # GPT risk
     try:
@@ -225,29 +506,23 @@ async def handle_webhook(req: Request, path: str):
         error_text = traceback.format_exc()
         g = default_gpt_fallback(payload, "风控模块异常")
 
-    # Save to DB
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "INSERT INTO signals(ts_utc, path, raw_text, json_payload, gpt_json, error) VALUES(?,?,?,?,?,?)",
-                (
-                    payload["recv_ts_utc"],
-                    path,
-                    text,
-                    json.dumps(payload, ensure_ascii=False),
-                    json.dumps(g, ensure_ascii=False),
-                    error_text,
-                ),
-            )
-            await db.commit()
-    except Exception as e:
-        print("DB write failed:", repr(e))
-
-    # WhatsApp send (optional)
+    # DB enqueue (batched by db_writer) + WhatsApp, concurrently
+    row = (
+        payload["recv_ts_utc"],
+        path,
+        raw,
+        orjson.dumps(g).decode(),
+        error_text,
+    )
     try:
         msg = format_whatsapp(payload, g)
-        await send_whatsapp(msg)
+        results = await asyncio.gather(
+            app.state.write_q.put(row),
+            send_whatsapp(msg),
+            return_exceptions=True,
+        )
+        for r in results:
+            if isinstance(r, Exception):
+                logger.error("Post-processing failed: %r", r)
     except Exception as e:
-        print("WhatsApp send failed:", repr(e))
-
-    return {"ok": True, "gpt": g}
+        logger.error("Post-processing failed: %r", e)
@@ -1,2 +1,2 @@
-uvicorn main:app --host 0.0.0.0 --port $PORT
+uvicorn main:app --host 0.0.0.0 --port $PORT --loop uvloop --http httptools
 